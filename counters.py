@@ -1,27 +1,136 @@
 import sqlite3
 import datetime
+import hashlib
 import threading
-from typing import Dict, Any
+import time
+from collections import defaultdict
+from dataclasses import asdict, astuple, dataclass
+from typing import Dict, Any, Optional, Tuple
+
+import orjson
+
+DAILY_COLUMNS = ('image_generations', 'video_generations', 'prompt_enhancements')
+
+# Seconds a computed /stats payload is reused before querying SQLite again
+STATS_CACHE_TTL = 1.0
+
+@dataclass(slots=True)
+class DailyStats:
+    """One daily_stats row; orjson serializes it straight from its slots"""
+    date: str
+    total_requests: int = 0
+    image_generations: int = 0
+    video_generations: int = 0
+    prompt_enhancements: int = 0
+    
+    def add(self, endpoint: str, n: int) -> None:
+        """Add n requests for endpoint to this row"""
+        self.total_requests += n
+        if endpoint in DAILY_COLUMNS:
+            setattr(self, endpoint, getattr(self, endpoint) + n)
+
+# (epoch second, ISO string) of the most recent now_iso() result
+_ts_cache: Tuple[int, str] = (0, "")
+
+def now_iso() -> str:
+    """Current local time as ISO text, formatted at most once per second"""
+    global _ts_cache
+    t = int(time.time())
+    cached_t, cached = _ts_cache
+    if t != cached_t:
+        cached = datetime.datetime.fromtimestamp(t).isoformat()
+        # Swap in one tuple so concurrent readers never see a half-updated pair
+        _ts_cache = (t, cached)
+    return cached
+
+def _format_last_used(value: Any) -> Any:
+    """Render an epoch last_used value as text; legacy rows already hold text"""
+    if isinstance(value, int):
+        # Same 'YYYY-MM-DD HH:MM:SS.ffffff' shape the sqlite3 datetime adapter wrote
+        return datetime.datetime.fromtimestamp(value).isoformat(' ', timespec='microseconds')
+    return value
 
 class ApiCounters:
+    _SQL_UPSERT_ENDPOINT = '''
+        INSERT INTO api_usage (endpoint, count, last_used)
+        VALUES (?, ?, ?)
+        ON CONFLICT(endpoint) DO UPDATE SET
+            count = count + excluded.count,
+            last_used = excluded.last_used
+    '''
+    
+    _SQL_UPSERT_DAILY = '''
+        INSERT INTO daily_stats (date, total_requests, image_generations, video_generations, prompt_enhancements)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(date) DO UPDATE SET
+            total_requests = total_requests + excluded.total_requests,
+            image_generations = image_generations + excluded.image_generations,
+            video_generations = video_generations + excluded.video_generations,
+            prompt_enhancements = prompt_enhancements + excluded.prompt_enhancements
+    '''
+    
     def __init__(self, db_path: str = 'usage.db'):
         self.db_path = db_path
+        # `lock` serializes database writes; `_buffer_lock` only guards the in-memory deltas
         self.lock = threading.Lock()
+        self._buffer_lock = threading.Lock()
+        self._pending: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._last_used: Dict[str, int] = {}
+        # (monotonic time computed, stats, etag) for the short-lived stats cache
+        self._stats_lock = threading.Lock()
+        self._stats_cache: Tuple[float, Optional[Dict[str, Any]], Optional[str]] = (0.0, None, None)
+        # A single shared connection; every use is serialized through `lock`
+        self._conn = self._connect()
         self._init_db()
     
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection with the performance pragmas applied"""
+        # Autocommit mode: write paths open their transactions explicitly with BEGIN
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        # page_size only takes effect on a fresh DB, and must precede the switch to WAL
+        conn.execute('PRAGMA page_size=4096')
+        # WAL lets /stats readers run alongside writers; NORMAL sync is safe under WAL
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA cache_size=-20000')
+        conn.execute('PRAGMA mmap_size=268435456')
+        return conn
+    
     def _init_db(self):
         """Initialize the database with required tables"""
-        with sqlite3.connect(self.db_path) as conn:
+        conn = self._conn
+        with self.lock, conn:
+            conn.execute('BEGIN')
+            # Databases from before endpoint became the primary key have an id column.
+            # Without the unique endpoint index, INSERT OR REPLACE never conflicted: every
+            # call added a row and the stored counts are meaningless, so the row count is
+            # the real total. With the index, rows are already one per endpoint.
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(api_usage)')]
+            if 'id' in columns:
+                indexes = [row[1] for row in conn.execute('PRAGMA index_list(api_usage)')]
+                count_expr = 'SUM(count)' if 'idx_api_usage_endpoint' in indexes else 'COUNT(*)'
+                conn.execute('DROP INDEX IF EXISTS idx_api_usage_endpoint')
+                conn.execute('ALTER TABLE api_usage RENAME TO api_usage_old')
+            
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS api_usage (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    endpoint TEXT NOT NULL,
+                    endpoint TEXT NOT NULL PRIMARY KEY,
                     count INTEGER DEFAULT 0,
-                    last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_used INTEGER DEFAULT (strftime('%s', 'now')),
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
             
+            if 'id' in columns:
+                conn.execute(f'''
+                    INSERT INTO api_usage (endpoint, count, last_used, created_at)
+                    SELECT endpoint, {count_expr}, MAX(last_used), MIN(created_at) FROM api_usage_old
+                    GROUP BY endpoint
+                ''')
+                conn.execute('DROP TABLE api_usage_old')
+            
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS daily_stats (
                     date TEXT PRIMARY KEY,
@@ -33,75 +142,111 @@ class ApiCounters:
                 )
             ''')
             
-            conn.commit()
+            # Running all-time total, kept in step with api_usage by flush()
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER)')
+            conn.execute('''
+                INSERT OR IGNORE INTO meta (k, v)
+                SELECT 'total', COALESCE(SUM(count), 0) FROM api_usage
+            ''')
     
     def increment(self, endpoint: str) -> None:
-        """Increment counter for specific endpoint"""
+        """Increment counter for specific endpoint (buffered until the next flush)"""
+        today = datetime.date.today().isoformat()
+        with self._buffer_lock:
+            self._pending[(today, endpoint)] += 1
+            self._last_used[endpoint] = int(time.time())
+    
+    def flush(self) -> None:
+        """Write buffered increments to the database in a single transaction"""
         with self.lock:
-            with sqlite3.connect(self.db_path) as conn:
-                # Update endpoint counter
-                conn.execute('''
-                    INSERT OR REPLACE INTO api_usage (endpoint, count, last_used)
-                    VALUES (?, COALESCE((SELECT count FROM api_usage WHERE endpoint = ?), 0) + 1, ?)
-                ''', (endpoint, endpoint, datetime.datetime.now()))
-                
-                # Update daily stats
-                today = datetime.date.today().isoformat()
-                
-                # Get current daily stats
-                cursor = conn.execute('SELECT * FROM daily_stats WHERE date = ?', (today,))
-                daily_row = cursor.fetchone()
-                
-                if daily_row:
-                    # Update existing record
-                    updates = {
-                        'total_requests': daily_row[1] + 1,
-                        'image_generations': daily_row[2] + (1 if endpoint == 'image_generations' else 0),
-                        'video_generations': daily_row[3] + (1 if endpoint == 'video_generations' else 0),
-                        'prompt_enhancements': daily_row[4] + (1 if endpoint == 'prompt_enhancements' else 0)
-                    }
+            with self._buffer_lock:
+                if not self._pending:
+                    return
+                pending, self._pending = self._pending, defaultdict(int)
+                last_used, self._last_used = self._last_used, {}
+            
+            # Aggregate deltas per endpoint and per day
+            endpoint_deltas: Dict[str, int] = defaultdict(int)
+            daily_deltas: Dict[str, DailyStats] = {}
+            for (date, endpoint), n in pending.items():
+                endpoint_deltas[endpoint] += n
+                if date not in daily_deltas:
+                    daily_deltas[date] = DailyStats(date)
+                daily_deltas[date].add(endpoint, n)
+            
+            conn = self._conn
+            try:
+                with conn:
+                    conn.execute('BEGIN')
                     
-                    conn.execute('''
-                        UPDATE daily_stats 
-                        SET total_requests = ?, image_generations = ?, video_generations = ?, prompt_enhancements = ?
-                        WHERE date = ?
-                    ''', (updates['total_requests'], updates['image_generations'], 
-                         updates['video_generations'], updates['prompt_enhancements'], today))
-                else:
-                    # Create new record
-                    conn.execute('''
-                        INSERT INTO daily_stats (date, total_requests, image_generations, video_generations, prompt_enhancements)
-                        VALUES (?, 1, ?, ?, ?)
-                    ''', (today, 
-                         1 if endpoint == 'image_generations' else 0,
-                         1 if endpoint == 'video_generations' else 0, 
-                         1 if endpoint == 'prompt_enhancements' else 0))
-                
-                conn.commit()
+                    # Update endpoint counters
+                    conn.executemany(self._SQL_UPSERT_ENDPOINT,
+                                     [(endpoint, n, last_used[endpoint]) for endpoint, n in endpoint_deltas.items()])
+                    
+                    # Update daily stats
+                    conn.executemany(self._SQL_UPSERT_DAILY,
+                                     [astuple(day) for day in daily_deltas.values()])
+                    
+                    # Update all-time total
+                    conn.execute("UPDATE meta SET v = v + ? WHERE k = 'total'", (sum(endpoint_deltas.values()),))
+            except Exception:
+                # The transaction was rolled back; put the deltas back so the next flush retries them
+                with self._buffer_lock:
+                    for key, n in pending.items():
+                        self._pending[key] += n
+                    for endpoint, ts in last_used.items():
+                        self._last_used[endpoint] = max(ts, self._last_used.get(endpoint, ts))
+                raise
     
     def get_stats(self) -> Dict[str, Any]:
-        """Get comprehensive usage statistics"""
-        with sqlite3.connect(self.db_path) as conn:
+        """Get comprehensive usage statistics as plain, stdlib-json-encodable dicts"""
+        stats = self.get_stats_with_etag()[0]
+        return {
+            **stats,
+            'today': asdict(stats['today']),
+            'last_7_days': [asdict(day) for day in stats['last_7_days']]
+        }
+    
+    def get_stats_with_etag(self) -> Tuple[Dict[str, Any], str]:
+        """Get usage statistics and their ETag, reusing results for STATS_CACHE_TTL seconds
+
+        Daily rows are DailyStats instances for orjson; use get_stats() for plain dicts.
+        """
+        # Concurrent callers queue on the lock and share a single DB traversal
+        with self._stats_lock:
+            computed_at, stats, etag = self._stats_cache
+            if stats is None or time.monotonic() - computed_at >= STATS_CACHE_TTL:
+                stats = self._query_stats()
+                # Leave the timestamp out so unchanged counters keep the same ETag
+                payload = orjson.dumps({k: v for k, v in stats.items() if k != 'timestamp'},
+                                       option=orjson.OPT_SORT_KEYS)
+                etag = '"' + hashlib.blake2b(payload, digest_size=8).hexdigest() + '"'
+                self._stats_cache = (time.monotonic(), stats, etag)
+        return stats, etag
+    
+    def _query_stats(self) -> Dict[str, Any]:
+        """Read statistics from the database and merge in unflushed increments"""
+        # Hold the flush lock so buffered deltas are never counted twice or missed
+        with self.lock:
+            conn = self._conn
+            
             # Get endpoint stats
             cursor = conn.execute('SELECT endpoint, count, last_used FROM api_usage ORDER BY count DESC')
             endpoint_stats = {}
             for row in cursor.fetchall():
                 endpoint_stats[row[0]] = {
                     'count': row[1],
-                    'last_used': row[2]
+                    'last_used': _format_last_used(row[2])
                 }
             
             # Get today's stats
             today = datetime.date.today().isoformat()
-            cursor = conn.execute('SELECT * FROM daily_stats WHERE date = ?', (today,))
+            cursor = conn.execute('''
+                SELECT date, total_requests, image_generations, video_generations, prompt_enhancements
+                FROM daily_stats WHERE date = ?
+            ''', (today,))
             today_row = cursor.fetchone()
-            
-            today_stats = {
-                'total_requests': today_row[1] if today_row else 0,
-                'image_generations': today_row[2] if today_row else 0,
-                'video_generations': today_row[3] if today_row else 0,
-                'prompt_enhancements': today_row[4] if today_row else 0
-            }
+            today_stats = DailyStats(*today_row) if today_row else DailyStats(today)
             
             # Get last 7 days stats
             cursor = conn.execute('''
@@ -111,39 +256,69 @@ class ApiCounters:
                 ORDER BY date DESC
             ''')
             
-            weekly_stats = []
-            for row in cursor.fetchall():
-                weekly_stats.append({
-                    'date': row[0],
-                    'total_requests': row[1],
-                    'image_generations': row[2],
-                    'video_generations': row[3],
-                    'prompt_enhancements': row[4]
-                })
+            weekly_stats = [DailyStats(*row) for row in cursor.fetchall()]
             
             # Calculate totals
-            cursor = conn.execute('SELECT SUM(count) FROM api_usage')
-            total_all_time = cursor.fetchone()[0] or 0
+            cursor = conn.execute("SELECT v FROM meta WHERE k = 'total'")
+            total_all_time = cursor.fetchone()[0]
+            
+            # Merge increments that have not been flushed yet
+            with self._buffer_lock:
+                pending = dict(self._pending)
+                last_used = dict(self._last_used)
+            
+            if pending:
+                weekly_by_date = {day.date: day for day in weekly_stats}
+                for (date, endpoint), n in pending.items():
+                    entry = endpoint_stats.setdefault(endpoint, {'count': 0, 'last_used': None})
+                    entry['count'] += n
+                    entry['last_used'] = _format_last_used(last_used[endpoint])
+                    total_all_time += n
+                    if date == today:
+                        today_stats.add(endpoint, n)
+                    if date not in weekly_by_date:
+                        weekly_by_date[date] = DailyStats(date)
+                    weekly_by_date[date].add(endpoint, n)
+                
+                endpoint_stats = dict(sorted(endpoint_stats.items(), key=lambda item: item[1]['count'], reverse=True))
+                weekly_stats = sorted(weekly_by_date.values(), key=lambda day: day.date, reverse=True)
             
             return {
                 'endpoint_stats': endpoint_stats,
                 'today': today_stats,
                 'last_7_days': weekly_stats,
                 'total_all_time': total_all_time,
-                'timestamp': datetime.datetime.now().isoformat()
+                'timestamp': now_iso()
             }
     
     def reset_stats(self) -> None:
         """Reset all statistics (use with caution)"""
-        with self.lock:
-            with sqlite3.connect(self.db_path) as conn:
+        # Same lock order as get_stats_with_etag, so an in-flight stats read can't
+        # write its pre-reset payload back into the cache
+        with self._stats_lock, self.lock:
+            with self._buffer_lock:
+                self._pending.clear()
+                self._last_used.clear()
+            self._stats_cache = (0.0, None, None)
+            conn = self._conn
+            with conn:
+                conn.execute('BEGIN')
                 conn.execute('DELETE FROM api_usage')
                 conn.execute('DELETE FROM daily_stats')
-                conn.commit()
+                conn.execute("UPDATE meta SET v = 0 WHERE k = 'total'")
     
     def get_endpoint_count(self, endpoint: str) -> int:
         """Get count for specific endpoint"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute('SELECT count FROM api_usage WHERE endpoint = ?', (endpoint,))
+        # Hold the flush lock across both reads so a flush can't move deltas in between
+        with self.lock:
+            cursor = self._conn.execute('SELECT count FROM api_usage WHERE endpoint = ?', (endpoint,))
             row = cursor.fetchone()
-            return row[0] if row else 0
\ No newline at end of file
+            with self._buffer_lock:
+                pending = sum(n for (_, name), n in self._pending.items() if name == endpoint)
+        return (row[0] if row else 0) + pending
+    
+    def close(self) -> None:
+        """Flush buffered increments and close the database connection"""
+        self.flush()
+        with self.lock:
+            self._conn.close()
\ No newline at end of file
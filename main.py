@@ -1,15 +1,21 @@
 import os
 import asyncio
 import json
-import datetime
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from typing import Optional
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import httpx
-from counters import ApiCounters
-from playwright_runner import run_web_generator
+import orjson
+from counters import ApiCounters, now_iso
+from playwright_runner import run_web_generator, start_browser, stop_browser, close_download_session
 
-app = FastAPI(title="Text2Video Backend", version="1.0.0")
+app = FastAPI(
+    title="Text2Video Backend",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # Enable CORS for frontend integration
 app.add_middleware(
@@ -23,6 +29,51 @@ app.add_middleware(
 # Initialize components
 counters = ApiCounters()
 
+# How often buffered usage counters are written to SQLite
+COUNTER_FLUSH_INTERVAL = float(os.getenv("COUNTER_FLUSH_INTERVAL", "5"))
+
+async def flush_counters_periodically():
+    """Persist buffered counter increments in the background"""
+    while True:
+        await asyncio.sleep(COUNTER_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(counters.flush)
+        except Exception as e:
+            print(f"Counter flush failed: {e}")
+
+@app.on_event("startup")
+async def startup():
+    # Shared client so Ollama/ComfyUI calls reuse pooled keep-alive connections
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=30.0,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+    )
+    # Cap in-flight calls at each backend's real parallelism so bursts queue here
+    app.state.comfy_sem = asyncio.Semaphore(int(os.getenv("COMFY_CONCURRENCY", "2")))
+    app.state.ollama_sem = asyncio.Semaphore(int(os.getenv("OLLAMA_CONCURRENCY", "2")))
+    app.state.counter_flush_task = asyncio.create_task(flush_counters_periodically())
+    # Warm up the shared browser; run_web_generator relaunches it on demand if this fails
+    try:
+        await start_browser()
+    except Exception as e:
+        print(f"Browser launch failed: {e}")
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Persist buffered usage first so a failing teardown step can't lose it
+    app.state.counter_flush_task.cancel()
+    try:
+        await asyncio.to_thread(counters.close)
+    finally:
+        try:
+            await app.state.http.aclose()
+        finally:
+            try:
+                await stop_browser()
+            finally:
+                await close_download_session()
+
 # Request models
 class TextPrompt(BaseModel):
     text: str
@@ -40,11 +91,50 @@ async def root():
 
 @app.get("/health")
 async def health():
-    return {"status": "healthy", "timestamp": datetime.datetime.now().isoformat()}
+    return {"status": "healthy", "timestamp": now_iso()}
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header (list, weak tags or "*") against an ETag"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
 
 @app.get("/stats")
-async def get_stats():
-    return counters.get_stats()
+async def get_stats(request: Request):
+    # SQLite reads run in a worker thread so they never stall the event loop
+    stats, etag = await asyncio.to_thread(counters.get_stats_with_etag)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    # Returning the response directly skips jsonable_encoder, so orjson
+    # serializes the DailyStats rows without converting them to dicts first
+    return ORJSONResponse(stats, headers={"ETag": etag})
+
+async def _enhance(text: str) -> str:
+    """Enhance a prompt with Ollama, falling back to the original text"""
+    ollama_url = os.getenv("OLLAMA_URL", "http://localhost:11434")
+    
+    try:
+        async with app.state.ollama_sem:
+            response = await app.state.http.post(
+                f"{ollama_url}/api/generate",
+                json={
+                    "model": "llama3.2",
+                    "prompt": f"Enhance this prompt for AI image/video generation. Make it more detailed and descriptive while keeping the core concept. Original: {text}",
+                    "stream": False
+                },
+                timeout=30.0
+            )
+        if response.status_code == 200:
+            return response.json().get("response", text).strip()
+    except:
+        pass
+    
+    # Fallback: return original if enhancement fails
+    return text
 
 @app.post("/enhance-prompt")
 async def enhance_prompt(request: TextPrompt):
@@ -55,28 +145,7 @@ async def enhance_prompt(request: TextPrompt):
         if not request.enhance:
             return {"original": request.text, "enhanced": request.text}
         
-        # Try Ollama first
-        ollama_url = os.getenv("OLLAMA_URL", "http://localhost:11434")
-        
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(
-                    f"{ollama_url}/api/generate",
-                    json={
-                        "model": "llama3.2",
-                        "prompt": f"Enhance this prompt for AI image/video generation. Make it more detailed and descriptive while keeping the core concept. Original: {request.text}",
-                        "stream": False
-                    },
-                    timeout=30.0
-                )
-                if response.status_code == 200:
-                    enhanced = response.json().get("response", request.text)
-                    return {"original": request.text, "enhanced": enhanced.strip()}
-            except:
-                pass
-        
-        # Fallback: return original if enhancement fails
-        return {"original": request.text, "enhanced": request.text}
+        return {"original": request.text, "enhanced": await _enhance(request.text)}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -90,8 +159,7 @@ async def generate_image(request: TextPrompt, background_tasks: BackgroundTasks)
         # Enhance prompt if requested
         prompt = request.text
         if request.enhance:
-            enhance_result = await enhance_prompt(request)
-            prompt = enhance_result["enhanced"]
+            prompt = await _enhance(prompt)
         
         if request.generator == "comfyui":
             return await generate_with_comfyui(prompt, "image")
@@ -112,55 +180,58 @@ async def generate_video(request: VideoRequest, background_tasks: BackgroundTask
         # Enhance prompt if requested
         prompt = request.prompt
         if request.enhance:
-            enhance_result = await enhance_prompt(TextPrompt(text=request.prompt, enhance=True))
-            prompt = enhance_result["enhanced"]
+            prompt = await _enhance(prompt)
         
         return await generate_with_comfyui(prompt, "video", request.duration)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Fixed-shape ComfyUI request body; only the JSON-escaped values are filled in per call
+COMFY_WORKFLOW_TEMPLATE = b'{"prompt": {"prompt": %s, "type": %s, "duration": %s}}'
+
 async def generate_with_comfyui(prompt: str, type: str = "image", duration: int = 5):
     """Generate content using ComfyUI"""
     comfy_url = os.getenv("COMFY_URL", "http://localhost:8188")
     
     # Basic workflow for ComfyUI (you'll need to customize this)
-    workflow = {
-        "prompt": prompt,
-        "type": type,
-        "duration": duration if type == "video" else None
-    }
+    body = COMFY_WORKFLOW_TEMPLATE % (
+        orjson.dumps(prompt),
+        orjson.dumps(type),
+        orjson.dumps(duration if type == "video" else None)
+    )
     
-    async with httpx.AsyncClient() as client:
-        try:
-            # Check if ComfyUI is running
-            health_response = await client.get(f"{comfy_url}/system_stats", timeout=5.0)
-            if health_response.status_code != 200:
-                raise HTTPException(status_code=503, detail="ComfyUI not available")
+    try:
+        # Check if ComfyUI is running
+        health_response = await app.state.http.get(f"{comfy_url}/system_stats", timeout=5.0)
+        if health_response.status_code != 200:
+            raise HTTPException(status_code=503, detail="ComfyUI not available")
             
-            # Submit generation job (customize endpoint as needed)
-            response = await client.post(
+        # Submit generation job (customize endpoint as needed)
+        async with app.state.comfy_sem:
+            response = await app.state.http.post(
                 f"{comfy_url}/prompt",
-                json={"prompt": workflow},
+                content=body,
+                headers={"Content-Type": "application/json"},
                 timeout=60.0
             )
             
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    "status": "generated",
-                    "type": type,
-                    "prompt": prompt,
-                    "result": result,
-                    "timestamp": datetime.datetime.now().isoformat()
-                }
-            else:
-                raise HTTPException(status_code=500, detail="ComfyUI generation failed")
+        if response.status_code == 200:
+            result = response.json()
+            return {
+                "status": "generated",
+                "type": type,
+                "prompt": prompt,
+                "result": result,
+                "timestamp": now_iso()
+            }
+        else:
+            raise HTTPException(status_code=500, detail="ComfyUI generation failed")
                 
-        except httpx.TimeoutException:
-            raise HTTPException(status_code=504, detail="Generation timeout")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"ComfyUI error: {str(e)}")
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="Generation timeout")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"ComfyUI error: {str(e)}")
 
 if __name__ == "__main__":
     import uvicorn
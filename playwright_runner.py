@@ -1,11 +1,92 @@
 import asyncio
+import hashlib
 import tempfile
 import os
 import base64
-from typing import Optional, Dict, Any
-from playwright.async_api import async_playwright, Browser, Page
+from typing import Optional, Dict, Any, List
+from playwright.async_api import async_playwright, Browser, Page, Route, TimeoutError as PlaywrightTimeoutError
 
-async def run_web_generator(prompt: str, site_url: str = "https://lmarena.ai", timeout: int = 30) -> Dict[str, Any]:
+# Collects tag name and src of every img/video in a single browser round-trip;
+# videos without a src attribute fall back to their first <source src> child
+MEDIA_SCRIPT = """els => els.map(e => ({
+    tag: e.tagName.toLowerCase(),
+    src: e.getAttribute('src') || e.querySelector('source[src]')?.getAttribute('src') || null
+}))"""
+
+# Combined button selectors, so one wait finds whichever button the page has.
+# Every alternative is restricted to :visible so a hidden match (e.g. a header
+# search form's submit button) can't win just by coming first in the document
+LMARENA_BUTTON_SELECTOR = ', '.join(selector + ':visible' for selector in [
+    'button:has-text("Generate")',
+    'button:has-text("Submit")',
+    'button:has-text("Create")',
+    'button[type="submit"]'
+])
+GENERIC_BUTTON_SELECTOR = ', '.join(selector + ':visible' for selector in [
+    'button:has-text("Generate")',
+    'button:has-text("Submit")',
+    'button:has-text("Create")',
+    'button:has-text("Run")',
+    'button[type="submit"]',
+    '.btn:has-text("Generate")'
+])
+
+# Resolves as soon as the first generated image or video shows up
+RESULT_READY_SCRIPT = """() => document.querySelectorAll(
+    'img[src^="blob:"], img[src^="data:"], img[src*="generated"], video[src], video source[src]'
+).length > 0"""
+
+# Resource types skipped while navigating so networkidle settles sooner.
+# Stylesheets stay allowed: blocked ones are never refetched after unroute, and the
+# handlers' :visible button selectors depend on the site's CSS hiding elements
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+# Long-lived browser shared by all calls; each call gets its own BrowserContext
+_playwright = None
+_browser: Optional[Browser] = None
+_browser_lock = asyncio.Lock()
+
+async def collect_media(page: Page) -> List[Dict[str, Any]]:
+    """Return [{"tag": ..., "src": ...}] for all img and video elements on the page"""
+    return await page.eval_on_selector_all('img, video', MEDIA_SCRIPT)
+
+async def _skip_heavy_resources(route: Route) -> None:
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def start_browser() -> Browser:
+    """Launch the shared Chromium instance if it is not already running"""
+    global _playwright, _browser
+    async with _browser_lock:
+        if _browser is None or not _browser.is_connected():
+            if _playwright is None:
+                _playwright = await async_playwright().start()
+            _browser = await _playwright.chromium.launch(
+                headless=True,
+                args=['--no-sandbox', '--disable-setuid-sandbox']
+            )
+        return _browser
+
+async def stop_browser() -> None:
+    """Close the shared browser and stop Playwright"""
+    global _playwright, _browser
+    async with _browser_lock:
+        try:
+            if _browser is not None:
+                await _browser.close()
+        finally:
+            # Stop Playwright even if closing a crashed browser raised
+            _browser = None
+            if _playwright is not None:
+                await _playwright.stop()
+                _playwright = None
+
+async def run_web_generator(prompt: str, site_url: str = "https://lmarena.ai", timeout: int = 30,
+                            fast_nav: bool = True) -> Dict[str, Any]:
     """
     Generate content using web-based AI generators via browser automation
     
@@ -13,6 +94,7 @@ async def run_web_generator(prompt: str, site_url: str = "https://lmarena.ai", t
         prompt: Text prompt for generation
         site_url: URL of the generator site
         timeout: Timeout in seconds
+        fast_nav: Skip images, fonts and media while the page loads
     
     Returns:
         Dictionary with generation results
@@ -26,40 +108,41 @@ async def run_web_generator(prompt: str, site_url: str = "https://lmarena.ai", t
     }
     
     try:
-        async with async_playwright() as p:
-            # Launch browser
-            browser = await p.chromium.launch(
-                headless=True,
-                args=['--no-sandbox', '--disable-setuid-sandbox']
-            )
+        browser = await start_browser()
+        
+        # Fresh context per call keeps cookies and storage isolated
+        context = await browser.new_context(
+            viewport={"width": 1280, "height": 720},
+            user_agent=USER_AGENT
+        )
+        
+        try:
+            page = await context.new_page()
+            if fast_nav:
+                await page.route("**/*", _skip_heavy_resources)
+            
+            # Navigate to the site
+            await page.goto(site_url, timeout=timeout*1000)
+            await page.wait_for_load_state('networkidle', timeout=timeout*1000)
+            
+            # Load everything again so generated media can be captured
+            if fast_nav:
+                await page.unroute("**/*", _skip_heavy_resources)
+            
+            # Site-specific automation
+            if "lmarena.ai" in site_url:
+                result = await handle_lmarena(page, prompt, timeout)
+            elif "huggingface.co" in site_url:
+                result = await handle_huggingface(page, prompt, timeout)
+            elif "replicate.com" in site_url:
+                result = await handle_replicate(page, prompt, timeout)
+            else:
+                # Generic approach - look for common input patterns
+                result = await handle_generic_site(page, prompt, timeout)
+            
+        finally:
+            await context.close()
             
-            try:
-                page = await browser.new_page()
-                
-                # Set viewport and user agent
-                await page.set_viewport_size({"width": 1280, "height": 720})
-                await page.set_extra_http_headers({
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-                })
-                
-                # Navigate to the site
-                await page.goto(site_url, timeout=timeout*1000)
-                await page.wait_for_load_state('networkidle', timeout=timeout*1000)
-                
-                # Site-specific automation
-                if "lmarena.ai" in site_url:
-                    result = await handle_lmarena(page, prompt, timeout)
-                elif "huggingface.co" in site_url:
-                    result = await handle_huggingface(page, prompt, timeout)
-                elif "replicate.com" in site_url:
-                    result = await handle_replicate(page, prompt, timeout)
-                else:
-                    # Generic approach - look for common input patterns
-                    result = await handle_generic_site(page, prompt, timeout)
-                
-            finally:
-                await browser.close()
-                
     except Exception as e:
         result["error"] = str(e)
         result["status"] = "error"
@@ -77,46 +160,34 @@ async def handle_lmarena(page: Page, prompt: str, timeout: int) -> Dict[str, Any
         await page.fill(input_selector, prompt)
         
         # Look for generate/submit button
-        button_selectors = [
-            'button:has-text("Generate")',
-            'button:has-text("Submit")', 
-            'button:has-text("Create")',
-            'button[type="submit"]'
-        ]
-        
-        button_clicked = False
-        for selector in button_selectors:
-            try:
-                await page.click(selector, timeout=5000)
-                button_clicked = True
-                break
-            except:
-                continue
-        
-        if not button_clicked:
+        try:
+            await page.locator(LMARENA_BUTTON_SELECTOR).first.click(timeout=5000)
+        except PlaywrightTimeoutError:
             return {"status": "failed", "error": "Could not find generate button"}
         
-        # Wait for results
-        await page.wait_for_timeout(3000)  # Initial wait
-        
-        # Look for generated content
-        await page.wait_for_selector('img, video, .result, .output', timeout=timeout*1000)
+        # Wait for the first generated content; on timeout still capture whatever
+        # is on the page, since results may come in a shape the predicate misses
+        try:
+            await page.wait_for_function(RESULT_READY_SCRIPT, timeout=timeout*1000)
+        except PlaywrightTimeoutError:
+            pass
         
         # Capture results
-        images = await page.query_selector_all('img')
-        videos = await page.query_selector_all('video')
+        items = await collect_media(page)
+        images = [item for item in items if item["tag"] == "img"]
+        videos = [item for item in items if item["tag"] == "video"]
         
         output = []
         
         # Process images
         for img in images[-3:]:  # Get last 3 images (likely results)
-            src = await img.get_attribute('src')
+            src = img["src"]
             if src and ('blob:' in src or 'data:' in src or 'generated' in src):
                 output.append({"type": "image", "url": src})
         
         # Process videos
         for video in videos[-2:]:  # Get last 2 videos
-            src = await video.get_attribute('src')
+            src = video["src"]
             if src:
                 output.append({"type": "video", "url": src})
         
@@ -146,14 +217,13 @@ async def handle_huggingface(page: Page, prompt: str, timeout: int) -> Dict[str,
         await page.wait_for_selector('.output, .gallery, img', timeout=timeout*1000)
         
         # Capture generated content
-        content = await page.query_selector_all('img, video')
+        content = await collect_media(page)
         output = []
         
         for item in content[-2:]:
-            src = await item.get_attribute('src')
-            tag_name = await item.evaluate('el => el.tagName.toLowerCase()')
+            src = item["src"]
             if src:
-                output.append({"type": tag_name, "url": src})
+                output.append({"type": item["tag"], "url": src})
         
         return {
             "status": "success" if output else "no_output",
@@ -181,14 +251,13 @@ async def handle_replicate(page: Page, prompt: str, timeout: int) -> Dict[str, A
         await page.wait_for_selector('.output, img, video', timeout=timeout*1000)
         
         # Get results
-        results = await page.query_selector_all('img, video')
+        results = await collect_media(page)
         output = []
         
         for result in results:
-            src = await result.get_attribute('src')
-            tag_name = await result.evaluate('el => el.tagName.toLowerCase()')
+            src = result["src"]
             if src and 'replicate' in src:
-                output.append({"type": tag_name, "url": src})
+                output.append({"type": result["tag"], "url": src})
         
         return {
             "status": "success" if output else "no_output",
@@ -220,39 +289,26 @@ async def handle_generic_site(page: Page, prompt: str, timeout: int) -> Dict[str
             return {"status": "failed", "error": "No input field found"}
         
         # Try to find and click submit button
-        button_selectors = [
-            'button:has-text("Generate")',
-            'button:has-text("Submit")',
-            'button:has-text("Create")',
-            'button:has-text("Run")',
-            'button[type="submit"]',
-            '.btn:has-text("Generate")'
-        ]
-        
-        button_clicked = False
-        for selector in button_selectors:
-            try:
-                await page.click(selector, timeout=3000)
-                button_clicked = True
-                break
-            except:
-                continue
-        
-        if not button_clicked:
+        try:
+            await page.locator(GENERIC_BUTTON_SELECTOR).first.click(timeout=5000)
+        except PlaywrightTimeoutError:
             return {"status": "failed", "error": "No submit button found"}
         
-        # Wait for potential results
-        await page.wait_for_timeout(5000)
+        # Wait for potential results; unknown sites may never match, so after the
+        # old 5 s budget capture whatever exists
+        try:
+            await page.wait_for_function(RESULT_READY_SCRIPT, timeout=5000)
+        except PlaywrightTimeoutError:
+            pass
         
         # Look for generated content
-        content = await page.query_selector_all('img, video')
+        content = await collect_media(page)
         output = []
         
         for item in content:
-            src = await item.get_attribute('src')
-            tag_name = await item.evaluate('el => el.tagName.toLowerCase()')
+            src = item["src"]
             if src and not src.startswith('data:image/svg'):
-                output.append({"type": tag_name, "url": src})
+                output.append({"type": item["tag"], "url": src})
         
         return {
             "status": "success" if output else "no_output",
@@ -265,37 +321,70 @@ async def handle_generic_site(page: Page, prompt: str, timeout: int) -> Dict[str
         return {"status": "failed", "error": str(e)}
 
 # Utility function for downloading generated content
+DOWNLOAD_EXTENSIONS = ('.png', '.jpg', '.mp4', '.bin')
+
+# Shared aiohttp session so downloads reuse one connection pool
+_download_session = None
+
+async def get_download_session():
+    """Return the shared aiohttp session, creating it on first use"""
+    global _download_session
+    import aiohttp
+    
+    if _download_session is None or _download_session.closed:
+        _download_session = aiohttp.ClientSession()
+    return _download_session
+
+async def close_download_session() -> None:
+    """Close the shared aiohttp session"""
+    global _download_session
+    if _download_session is not None:
+        await _download_session.close()
+        _download_session = None
+
 async def download_content(url: str, output_dir: str = "./outputs") -> Optional[str]:
-    """Download generated content from URL"""
+    """Download generated content from URL, reusing an earlier download of the same URL"""
     try:
-        import aiohttp
         import aiofiles
         
         os.makedirs(output_dir, exist_ok=True)
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    # Determine file extension
-                    content_type = response.headers.get('content-type', '')
-                    if 'image' in content_type:
-                        ext = '.png' if 'png' in content_type else '.jpg'
-                    elif 'video' in content_type:
-                        ext = '.mp4'
-                    else:
-                        ext = '.bin'
-                    
-                    # Generate filename
-                    filename = f"generated_{int(asyncio.get_event_loop().time())}{ext}"
-                    filepath = os.path.join(output_dir, filename)
-                    
-                    # Save file
-                    async with aiofiles.open(filepath, 'wb') as f:
+        # Content-addressed filename: the same URL always maps to the same file
+        name = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+        for ext in DOWNLOAD_EXTENSIONS:
+            filepath = os.path.join(output_dir, name + ext)
+            if os.path.exists(filepath):
+                return filepath
+        
+        session = await get_download_session()
+        async with session.get(url) as response:
+            if response.status == 200:
+                # Determine file extension
+                content_type = response.headers.get('content-type', '')
+                if 'image' in content_type:
+                    ext = '.png' if 'png' in content_type else '.jpg'
+                elif 'video' in content_type:
+                    ext = '.mp4'
+                else:
+                    ext = '.bin'
+                
+                filepath = os.path.join(output_dir, name + ext)
+                
+                # Save to a temporary name first so a partial download is never reused
+                partial = f"{filepath}.{os.getpid()}.{id(response)}.part"
+                try:
+                    async with aiofiles.open(partial, 'wb') as f:
                         async for chunk in response.content.iter_chunked(8192):
                             await f.write(chunk)
-                    
-                    return filepath
-                    
+                    os.replace(partial, filepath)
+                except BaseException:
+                    # Don't leave half-written files behind (errors and cancellation alike)
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                    raise
+                
+                return filepath
+                
     except Exception as e:
         print(f"Download failed: {e}")
-        return None
\ No newline at end of file
+        return None